@@ -3,6 +3,10 @@
 '''
 Reads status from database create by parse_backup_email and returns it
 
+The database uses SQLite WAL journaling, so even readers need write access
+to the directory containing it, to create the backup_email.db-shm and
+backup_email.db-wal files: make sure it is writable by the nagios user too.
+
 Return codes are:
 0   OK
 1   WARNING
@@ -35,6 +39,7 @@ VERSION = '0.5'
 DB = 'backup_email.db'
 
 import sys, os
+import time
 import traceback
 import datetime
 import argparse
@@ -49,12 +54,14 @@ class Ret:
 	UNKNOWN = 3
 	
 	CODES = (UNKNOWN, OK, WARNING, CRITICAL)
+	# Severity rank of every code, higher is worse
+	_RANK = {UNKNOWN: 0, OK: 1, WARNING: 2, CRITICAL: 3}
 	DESCR = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
 
 	def __init__(self):
 		self.__code = self.UNKNOWN
-		self.__message = None
-		self.__detail = None
+		self.__message = []
+		self.__detail = []
 	
 	def getCode(self):
 		''' Returns numeric exit code '''
@@ -62,8 +69,8 @@ class Ret:
 	
 	def getText(self):
 		''' Returns textual message '''
-		return self.DESCR[self.__code] + ( ': '+self.__message if self.__message!=None else '') \
-			+ ( "\n"+self.__detail if self.__detail!=None else '')
+		return self.DESCR[self.__code] + ( ': '+'; '.join(self.__message) if self.__message else '') \
+			+ ( "\n"+"\n----------\n".join(self.__detail) if self.__detail else '')
 	
 	def change(self, code, message=None, detail=None):
 		'''
@@ -71,23 +78,17 @@ class Ret:
 			previous, then old condition is kept. Is condition is the same, then
 			message is concatenated
 		'''
-		if not code in self.CODES:
+		if code not in self._RANK:
 			raise RuntimeError('Unvalid code: ' + str(code))
 		if code == self.__code:
 			if message != None:
-				if self.__message == None:
-					self.__message = message
-				else:
-					self.__message += '; ' + message
+				self.__message.append(message)
 			if detail != None:
-				if self.__detail == None:
-					self.__detail = detail
-				else:
-					self.__detail += "\n----------\n" + detail
-		elif self.CODES.index(code) > self.CODES.index(self.__code):
+				self.__detail.append(detail)
+		elif self._RANK[code] > self._RANK[self.__code]:
 			self.__code = code
-			self.__message = str(message)
-			self.__detail = str(detail)
+			self.__message = [str(message)]
+			self.__detail = [str(detail)]
 		else:
 			pass
 
@@ -114,20 +115,27 @@ class Main:
 		if not res:
 			ret.change(Ret.UNKNOWN, "Job {} has never been recorded".format(self.job))
 			return ret
-		time = datetime.datetime.strptime(res[0], r'%Y-%m-%dT%H:%M:%S.%f')
+		last = res[0]
+		if isinstance(last, str):
+			# Database created by an older version, "last" has TEXT affinity
+			if last.isdigit():
+				last = int(last)
+			else:
+				last = int(datetime.datetime.fromisoformat(last).timestamp() * 1000000)
 		status = bool(res[1])
-		elapsed = datetime.datetime.now() - time
+		elapsed = time.time() - last / 1000000
 		stxt = 'Succesful' if status else 'Failed'
-		mex = "{} job {} recorded on {:%d-%m-%Y at %H:%M:%S}".format(stxt, self.job, time)
+		mex = "{} job {} recorded on {:%d-%m-%Y at %H:%M:%S}".format(stxt, self.job,
+			datetime.datetime.fromtimestamp(last / 1000000))
 
 		if status:
 			ret.change(Ret.OK, mex)
 		else:
 			ret.change(Ret.CRITICAL, mex)
 
-		if elapsed.total_seconds() > 60 * 60 * self.crit:
+		if elapsed > 60 * 60 * self.crit:
 			ret.change(Ret.CRITICAL, mex)
-		elif elapsed.total_seconds() > 60 * 60 * self.warn:
+		elif elapsed > 60 * 60 * self.warn:
 			ret.change(Ret.WARNING, mex)
 
 		return ret
@@ -6,6 +6,11 @@ This script is intended to be used in conjunction with procmail.
 Parses an email from stdin, trying to recognize backup report emails. Stores
 results into internal database to be read from check_backup_email.py
 
+The database uses SQLite WAL journaling: check_backup_email.py needs write
+access to the database directory too, to create the backup_email.db-shm and
+backup_email.db-wal files, so that directory must be writable by both the
+procmail and the nagios users.
+
 @author: Gabriele Tozzi <gabriele@tozzi.eu>
 
 This program is free software: you can redistribute it and/or modify
@@ -28,11 +33,12 @@ DB = 'backup_email.db'
 import os, sys
 import traceback
 import re
-import datetime
+import time
 import logging
 import logging.handlers
+import collections
 import configparser
-import email.parser
+import email
 import sqlite3
 
 
@@ -46,93 +52,138 @@ handler.setFormatter(formatter)
 
 log.addHandler(handler)
 
-# Read config
-try:
+
+# Any of these characters makes a pattern more than a plain string
+META_RE = re.compile(r'[.^$*+?{}\[\]\\|()]')
+# Leading and trailing blanks of every line, like str.strip() on each of them
+BLANKS_RE = re.compile(r'^[^\S\n]+|[^\S\n]+$', re.M)
+
+# A job definition: name, format name and tuple of (header, compiled regex)
+Job = collections.namedtuple('Job', ('name', 'format', 'matchers'))
+# A format definition: tuple of (header, compiled regex) and body matcher
+Format = collections.namedtuple('Format', ('headers', 'body'))
+
+def headersMatch(msg, matchers):
+	''' Tells whether all the (header, compiled regex) matchers match msg '''
+	for k, pattern in matchers:
+		v = msg.get(k)
+		if v is None or not pattern.match(v):
+			return False
+	return True
+
+def loadConfig(cfgfile):
+	''' Reads the config file and precompiles all its regexes
+	@return tuple (tuple of Job, dict of Format)
+	'''
 	config = configparser.ConfigParser()
-	cfgfile = os.path.splitext(os.path.abspath(__file__))[0] + '.ini'
 	if not config.read(cfgfile):
 		raise RuntimeError('Config file %s not found', cfgfile)
 
-	# Reads STDIN until two consecutive empty line detected (end of email)
-	parser = email.parser.FeedParser()
-	for line in sys.stdin:
-		parser.feed(line)
-	msg = parser.close()
-
-	# Parse the message
+	jobs = []
+	format_matchers = {}
+	for sec in config.sections():
+		if sec[:4] == 'job_':
+			matchers = tuple((k, re.compile(v)) for k, v in config.items(sec) if k[0] != '_')
+			jobs.append(Job(sec[4:], config.get(sec, '_format', fallback=None), matchers))
+		elif sec[:7] == 'format_':
+			body = config.get(sec, '_body', fallback=None)
+			if body is None:
+				bodyMatcher = None
+			else:
+				# Scan the whole body at once: the pattern must match at the
+				# beginning of any line, once the lines have been stripped. Plain
+				# strings are also kept aside for a quick substring pre-check
+				literal = None if META_RE.search(body) else body
+				bodyMatcher = (literal, re.compile(r'^(?:' + body + ')', re.M))
+			headers = tuple((k, re.compile(v)) for k, v in config.items(sec) if k[0] != '_')
+			format_matchers[sec[7:]] = Format(headers, bodyMatcher)
+
+	return tuple(jobs), format_matchers
+
+def parseMessage(data):
+	''' Parses a raw email as text, so that headers with 8-bit characters
+	are returned as str and not as email.header.Header
+	@param data bytes: The whole email
+	'''
+	return email.message_from_string(data.decode('utf-8', 'surrogateescape'))
+
+def openDb(dbfile):
+	''' Opens the status database, creating the schema when new '''
+	newdb = not os.path.exists(dbfile) or os.path.getsize(dbfile) == 0
+	conn = sqlite3.connect(dbfile)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL")
+	if newdb:
+		q = """
+			CREATE TABLE IF NOT EXISTS job_status (
+				name TEXT,
+				last INTEGER,
+				status INTEGER,
+				PRIMARY KEY (name ASC)
+			)
+		"""
+		with conn:
+			conn.execute(q)
+	return conn
+
+def matchMessage(msg, jobs, format_matchers):
+	''' Matches msg against the configured jobs, the first matching job wins
+	@return list of (job name, time, status) rows to be stored
+	'''
 	log.debug('message received, %d characters, subject: %s', len(str(msg)), msg['Subject'])
 
 	# Try to match the message
-	job = None
-	for sec in config.sections():
-		if sec[:4] == 'job_':
-			j = sec[4:]
-			matched = None
-			for k, v in config.items(sec):
-				if k[0] != '_':
-					if k in msg and re.match(v, msg[k]):
-						matched = True
-					else:
-						matched = False
-						break
-			if matched:
-				log.info('Detected email for job %s', j)
-				job = j
-				break
-	if not job:
-		sys.exit(0)
+	job = next((job for job in jobs if job.matchers and headersMatch(msg, job.matchers)), None)
+	if job is None:
+		return []
+	log.info('Detected email for job %s', job.name)
 
 	# Read job format
-	fmt = config.get('job_'+job, '_format')
-	matched = None
-	for k, v in config.items('format_' + fmt):
-		if k[0] != '_':
-			if k in msg and re.match(v, msg[k]):
-				matched = True
-				continue
-			else:
-				matched = False
-				break
-		elif k == '_body':
-			bodyMatched = None
-			bodyRe = re.compile(v)
-			for line in msg.get_payload().split('\n'):
-				if bodyRe.match(line.strip()):
-					bodyMatched = True
-					break
-			if bodyMatched:
-				matched = True
-				continue
-			else:
-				matched = False
-				break
+	fmt = format_matchers[job.format]
+	if not fmt.headers:
+		matched = None
+	else:
+		matched = headersMatch(msg, fmt.headers)
+	if matched is not False and fmt.body is not None:
+		literal, pattern = fmt.body
+		# Strip every line in one pass, this also drops the \r of CRLF
+		payload = BLANKS_RE.sub('', msg.get_payload())
+		if literal is not None and literal not in payload:
+			matched = False
+		else:
+			matched = bool(pattern.search(payload))
 	if matched:
 		log.info('Success status detected')
 	else:
 		log.info('Failure status detected')
 
-	# Write processing result
-	dbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), DB)
-	conn = sqlite3.connect(dbfile)
-	cur = conn.cursor()
-	q = """
-		CREATE TABLE IF NOT EXISTS job_status (
-			name TEXT,
-			last TEXT,
-			status INTEGER,
-			PRIMARY KEY (name ASC)
-		)
-	"""
-	cur.execute(q)
+	return [(job.name, time.time_ns() // 1000, int(bool(matched)))]
 
-	q = "INSERT OR REPLACE INTO job_status(name, last, status) VALUES(?, ?, ?)"
-	cur.execute(q, (job, datetime.datetime.now().isoformat(), int(matched)))
+def storeRows(conn, rows):
+	''' Writes processing result rows in a single transaction '''
+	with conn:
+		q = "INSERT OR REPLACE INTO job_status(name, last, status) VALUES(?, ?, ?)"
+		conn.executemany(q, rows)
 
-	conn.commit()
+def logException(e):
+	log.critical('Caught exception: %s on %s', e, traceback.format_exc().splitlines()[1].strip())
 
 
-except Exception as e:
-	log.critical('Caught exception: %s on %s', e, traceback.format_exc().splitlines()[1].strip())
-	sys.exit(1)
+if __name__ == '__main__':
+	try:
+		cfgfile = os.path.splitext(os.path.abspath(__file__))[0] + '.ini'
+		jobs, format_matchers = loadConfig(cfgfile)
+
+		# Reads the whole email from STDIN at once, procmail closes it at the end
+		msg = parseMessage(sys.stdin.buffer.read())
+
+		rows = matchMessage(msg, jobs, format_matchers)
+		if rows:
+			dbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), DB)
+			storeRows(openDb(dbfile), rows)
+
+	except Exception as e:
+		logException(e)
+		sys.exit(1)
 
-sys.exit(0)
+	sys.exit(0)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+'''
+Long running alternative to parse_backup_email.py, to be used in conjunction
+with procmail.
+
+Reads the configuration and opens the database only once, then listens on an
+UNIX socket: every connection must send a whole email and close its writing
+side. The email is processed like parse_backup_email.py does, then the daemon
+answers with the exit code parse_backup_email.py would have returned.
+
+Example .procmailrc recipe:
+:0 c
+| socat - UNIX-CONNECT:/run/parse_backup_email.sock
+
+@author: Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+NAME = 'parse_backup_email_daemon'
+VERSION = '0.1'
+SOCKET = '/run/parse_backup_email.sock'
+# Seconds a client may take to send its email
+TIMEOUT = 30
+
+import os, sys
+import signal
+import socket
+import argparse
+import socketserver
+
+import parse_backup_email as pbe
+
+
+class Handler(socketserver.StreamRequestHandler):
+	''' Processes a single email '''
+
+	# Connections are served one at a time: never wait forever for a client
+	timeout = TIMEOUT
+
+	def handle(self):
+		try:
+			msg = pbe.parseMessage(self.rfile.read())
+			rows = pbe.matchMessage(msg, self.server.jobs, self.server.format_matchers)
+			if rows:
+				pbe.storeRows(self.server.conn, rows)
+		except Exception as e:
+			pbe.logException(e)
+			self.wfile.write(b'1\n')
+		else:
+			self.wfile.write(b'0\n')
+
+
+class Server(socketserver.UnixStreamServer):
+	''' Keeps config and database connection shared between requests '''
+
+	def __init__(self, path, cfgfile, dbfile):
+		self.jobs, self.format_matchers = pbe.loadConfig(cfgfile)
+		self.conn = pbe.openDb(dbfile)
+
+		# Remove stale socket left by a previous run, but never steal the one
+		# of a running instance
+		if os.path.exists(path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(path)
+			except ConnectionRefusedError:
+				os.unlink(path)
+			else:
+				raise RuntimeError('Another instance is listening on {}'.format(path))
+			finally:
+				probe.close()
+		super().__init__(path, Handler)
+
+
+if __name__ == '__main__':
+	basepath = os.path.dirname(os.path.abspath(pbe.__file__))
+
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument("-s", "--socket", default=SOCKET, help="path of the UNIX socket to listen on")
+	args = parser.parse_args()
+
+	try:
+		server = Server(args.socket, os.path.join(basepath, pbe.NAME + '.ini'), os.path.join(basepath, pbe.DB))
+	except Exception as e:
+		pbe.logException(e)
+		sys.exit(1)
+
+	# Exit cleanly when stopped by the service manager
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	pbe.log.info('Listening on %s', args.socket)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.unlink(args.socket)
+
+	sys.exit(0)
@@ -12,11 +12,16 @@ import sys
 import enum
 import json
 import typing
+import shutil
 import logging
 import datetime
 import subprocess
 
 
+# Resolved once at import time
+BTRFS_PATH = shutil.which('btrfs') or '/usr/bin/btrfs'
+
+
 class IcingaStatus(enum.IntEnum):
 	OK = 0
 	WARNING = 1
@@ -27,6 +32,8 @@ class IcingaStatus(enum.IntEnum):
 class PerfDataRow:
 	""" @see https://www.monitoring-plugins.org/doc/guidelines.html#AEN201 """
 
+	__slots__ = ('label', 'value', 'uom', 'warn', 'crit', 'min', 'max')
+
 	def __init__(self, label:str, value:float, uom:str|None=None,
 			warn:float|None=None, crit:float|None=None, min:float|None=None, max:float|None=None) -> None:
 		self.label = label
@@ -39,26 +46,8 @@ class PerfDataRow:
 
 	def __str__(self) -> str:
 		""" 'label'=value[UOM];[warn];[crit];[min];[max] """
-		if ' ' in self.label:
-			out = f"'{self.label}'"
-		else:
-			out = self.label
-		out += f"={self.value}"
-		if self.uom:
-			out += self.uom
-		out += ';'
-		if self.warn:
-			out += f'{self.warn}'
-		out += ';'
-		if self.crit:
-			out += f'{self.crit}'
-		out += ';'
-		if self.min:
-			out += f'{self.min}'
-		out += ';'
-		if self.max:
-			out += f'{self.max}'
-		return out
+		label = f"'{self.label}'" if ' ' in self.label else self.label
+		return f"{label}={self.value}{self.uom or ''};{self.warn or ''};{self.crit or ''};{self.min or ''};{self.max or ''}"
 
 
 class CheckResult(typing.NamedTuple):
@@ -69,41 +58,102 @@ class CheckResult(typing.NamedTuple):
 
 class BtrfChecker:
 
-	# Scrub regexes
-	SCRUB_STARTED_RE = re.compile('^Scrub started:\s+([A-Za-z]{3}\s+[A-Za-z]{3}\s+[0-9]{1,2}\s+[0-9]{1,2}:[0-9]{2}:[0-9]{2}\s+[0-9]{4})$', re.M)
-	STATUS_RE = re.compile('^Status:\s+([a-z]+)$', re.M)
-	DURATION_RE = re.compile('^Duration:\s+([0-9]+):([0-9]{1,2}):([0-9]{1,2})$', re.M)
-	PERF_ROW_RE = re.compile('^\s*([a-z_]+):\s*([0-9]+)$', re.M)
+	# Scrub regex, parses all the interesting rows in a single pass
+	SCRUB_RE = re.compile(rb'^(?:'
+		rb'Scrub started:\s+(?P<started>[A-Za-z]{3}\s+[A-Za-z]{3}\s+[0-9]{1,2}\s+[0-9]{1,2}:[0-9]{2}:[0-9]{2}\s+[0-9]{4})'
+		rb'|Status:\s+(?P<status>[a-z]+)'
+		rb'|Duration:\s+(?P<hours>[0-9]+):(?P<mins>[0-9]{1,2}):(?P<secs>[0-9]{1,2})'
+		rb'|\s*(?P<key>[a-z_]+):\s*(?P<val>[0-9]+)'
+		rb')$', re.M)
 
 	def __init__(self, volume_path:str) -> None:
 		self.log = logging.getLogger('btrfscheck')
 		self.volume_path = volume_path
 		self.is_root = os.geteuid() == 0
-
-		cmd = ('which', 'btrfs')
-		self.btrfs_path = subprocess.check_output(cmd, text=True).strip()
+		self.btrfs_path = BTRFS_PATH
 
 	def __run_cmd(self, cmd:list[str]) -> subprocess.CompletedProcess:
 		if not self.is_root:
 			cmd = [ 'sudo' ] + cmd
-		res = subprocess.run(cmd, capture_output=True, text=True)
-		self.log.debug('STDOUT: %s', res.stdout)
-		self.log.debug('STDERR: %s', res.stderr)
+		# stderr is only needed for debugging
+		debug = self.log.isEnabledFor(logging.DEBUG)
+		stderr = subprocess.PIPE if debug else subprocess.DEVNULL
+		res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=stderr, check=False)
+		if debug:
+			self.log.debug('STDOUT: %s', res.stdout)
+			self.log.debug('STDERR: %s', res.stderr)
 		return res
 
-	def check_last_scrub_started(self, warn_days:int, crit_days:int) -> CheckResult:
-		''' Checks last scrub started date '''
+	@staticmethod
+	def __describe_failure(res:subprocess.CompletedProcess) -> str:
+		''' Returns a short description of a failed command for error messages '''
+		out = f'exit code {res.returncode}'
+		if res.stderr:
+			out += f', {res.stderr.decode(errors="replace")}'
+		return out
+
+	def __scrub_status_json(self) -> tuple[datetime.datetime, str|None, int|None, list[tuple[str,int]]]|None:
+		''' Reads scrub status in JSON format, returns None if unparsable '''
+		cmd = [ self.btrfs_path, '--format', 'json', 'scrub', 'status', '-R', self.volume_path ]
+		res = self.__run_cmd(cmd)
+
+		try:
+			scrub = json.loads(res.stdout)['status'][0]
+			scrub_start = datetime.datetime.fromisoformat(scrub['start_time'])
+		except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError):
+			self.log.warning('Unparsable json scrub status, falling back to text')
+			return None
+		if scrub_start.tzinfo is not None:
+			# Compared with naive local time later on
+			scrub_start = scrub_start.astimezone().replace(tzinfo=None)
+
+		counters = [ (key, val) for key, val in scrub.items()
+			if type(val) is int and key != 'duration_seconds' ]
+		return scrub_start, scrub.get('status'), scrub.get('duration_seconds'), counters
+
+	def __scrub_status_text(self) -> tuple[datetime.datetime, str|None, int|None, list[tuple[str,int]]]:
+		''' Reads scrub status parsing text output, raises ValueError if unparsable '''
 		cmd = [ self.btrfs_path, 'scrub', 'status', '-R', self.volume_path ]
 		res = self.__run_cmd(cmd)
 
-		m = self.SCRUB_STARTED_RE.search(res.stdout)
-		if not m:
-			return CheckResult(IcingaStatus.UNKNOWN, f'Unparsable stdout, {res.stderr}', [])
+		started = None
+		duration = None
+		text_status = None
+		counters:list[tuple[str,int]] = []
+		for m in self.SCRUB_RE.finditer(res.stdout):
+			if m.group('started'):
+				started = m.group('started').decode()
+			elif m.group('status'):
+				text_status = m.group('status').decode()
+			elif m.group('hours'):
+				hours, mins, secs = m.group('hours', 'mins', 'secs')
+				duration = int(secs) + int(mins) * 60 + int(hours) * 60 * 60
+			else:
+				counters.append((m.group('key').decode(), int(m.group('val'))))
+
+		if not started:
+			raise ValueError(f'Unparsable stdout, {self.__describe_failure(res)}')
 
 		try:
-			scrub_start = datetime.datetime.strptime(m.group(1), r'%a %b %d %H:%M:%S %Y')
+			scrub_start = datetime.datetime.strptime(started, r'%a %b %d %H:%M:%S %Y')
 		except ValueError:
-			return CheckResult(IcingaStatus.UNKNOWN, f'Unparsable datetime, {m.group(1)}', [])
+			raise ValueError(f'Unparsable datetime, {started}')
+
+		return scrub_start, text_status, duration, counters
+
+	def check_last_scrub_started(self, warn_days:int, crit_days:int, use_json:bool=False) -> CheckResult:
+		''' Checks last scrub started date. JSON scrub status is opt-in: its
+		availability and layout depend on the btrfs-progs version, text output
+		is parsed when it is not wanted or not usable '''
+		scrub = None
+		if use_json:
+			scrub = self.__scrub_status_json()
+		try:
+			if scrub is None:
+				scrub = self.__scrub_status_text()
+		except ValueError as e:
+			return CheckResult(IcingaStatus.UNKNOWN, str(e), [])
+		scrub_start, text_status, duration, counters = scrub
 
 		now = datetime.datetime.now()
 		warn = now - datetime.timedelta(days=warn_days)
@@ -118,33 +168,21 @@ class BtrfChecker:
 
 		perf_data:list[PerfDataRow] = []
 
-		m = self.DURATION_RE.search(res.stdout)
-		if not m:
+		if duration is None:
 			self.log.warning('Could not find duration')
 		else:
-			hours, mins, secs = m.groups()
-			try:
-				perf_data.append(PerfDataRow('duration', int(secs) + int(mins) * 60 + int(hours) * 60 * 60, 's'))
-			except ValueError:
-				self.log.warning('Could not parse duration')
+			perf_data.append(PerfDataRow('duration', duration, 's'))
 
-		text_status = None
-		m = self.STATUS_RE.search(res.stdout)
-		if not m:
+		if text_status is None:
 			self.log.warning('Could not find status')
-		else:
-			text_status = m.group(1)
 
-		for m in self.PERF_ROW_RE.finditer(res.stdout):
-			try:
-				perf_data.append(PerfDataRow(m.group(1), int(m.group(2))))
-			except ValueError:
-				self.log.warning('Could not parse perfdata row')
+		for key, val in counters:
+			perf_data.append(PerfDataRow(key, val))
 
 		self.log.debug('Perf data: %s', perf_data)
 		return CheckResult(status, text_status, perf_data)
 
-	def check_device_stats(self, warn_count:int, crit_count:int) -> CheckResult:
+	def check_device_stats(self, warn_count:int, crit_count:int, with_perf_data:bool=True) -> CheckResult:
 		''' Checks device statistics '''
 		cmd = [ self.btrfs_path, '--format', 'json', 'device', 'stats', self.volume_path ]
 		res = self.__run_cmd(cmd)
@@ -152,7 +190,14 @@ class BtrfChecker:
 		try:
 			data = json.loads(res.stdout)
 		except json.JSONDecodeError:
-			return CheckResult(IcingaStatus.UNKNOWN, f'Unparsable json stdout, {res.stderr}', [])
+			return CheckResult(IcingaStatus.UNKNOWN, f'Unparsable json stdout, {self.__describe_failure(res)}', [])
+
+		# Fast path for healthy volumes when perf data is not wanted
+		if not with_perf_data:
+			total = sum(int(val) for device in data['device-stats']
+				for key, val in device.items() if key.endswith('_errs'))
+			if total == 0:
+				return CheckResult(IcingaStatus.OK, '', [])
 
 		errors:list[str] = []
 		status = IcingaStatus.OK
@@ -174,7 +219,8 @@ class BtrfChecker:
 				if err_count > 0:
 					errors.append(f'{device_name} {key}: {err_count}')
 
-				perf_data.append(PerfDataRow(f'dev{device_id}_{key}', err_count, 'c'))
+				if with_perf_data:
+					perf_data.append(PerfDataRow(f'dev{device_id}_{key}', err_count, 'c'))
 
 		return CheckResult(status, ', '.join(errors), perf_data)
 
@@ -190,10 +236,12 @@ if __name__ == '__main__':
 	parser_lss = subparsers.add_parser('last_scrub_started', help='checks when last scrub has been started for volume')
 	parser_lss.add_argument('-w', '--warn', type=int, default=40, help='warning days interval')
 	parser_lss.add_argument('-c', '--crit', type=int, default=100, help='critical days interval')
+	parser_lss.add_argument('-j', '--json', action='store_true', help='read scrub status in JSON format, needs a recent btrfs-progs')
 
 	parser_lss = subparsers.add_parser('device_stats', help='checks device statistic counters')
 	parser_lss.add_argument('-w', '--warn', type=int, default=0, help='warning count')
 	parser_lss.add_argument('-c', '--crit', type=int, default=0, help='critical count')
+	parser_lss.add_argument('-n', '--no-perf-data', action='store_true', help='do not output perf data')
 
 	args = parser.parse_args()
 
@@ -205,9 +253,9 @@ if __name__ == '__main__':
 		bc = BtrfChecker(args.volume_path)
 
 		if args.check == 'last_scrub_started':
-			res = bc.check_last_scrub_started(args.warn, args.crit)
+			res = bc.check_last_scrub_started(args.warn, args.crit, args.json)
 		elif args.check == 'device_stats':
-			res = bc.check_device_stats(args.warn, args.crit)
+			res = bc.check_device_stats(args.warn, args.crit, not args.no_perf_data)
 		else:
 			raise NotImplementedError(args.check)
 
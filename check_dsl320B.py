@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # kate: space-indent on; mixedindent off;
 
@@ -40,7 +40,7 @@ import re
 import argparse
 import os, sys
 import traceback
-import telnetlib
+import socket
 
 
 class Ret(object):
@@ -51,12 +51,14 @@ class Ret(object):
     UNKNOWN = 3
     
     CODES = (UNKNOWN, OK, WARNING, CRITICAL)
+    # Severity rank of every code, higher is worse
+    _RANK = {UNKNOWN: 0, OK: 1, WARNING: 2, CRITICAL: 3}
     DESCR = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
 
     def __init__(self):
         self.__code = self.UNKNOWN
-        self.__message = None
-        self.__detail = None
+        self.__message = []
+        self.__detail = []
     
     def getCode(self):
         ''' Returns numeric exit code '''
@@ -64,8 +66,8 @@ class Ret(object):
     
     def getText(self):
         ''' Returns textual message '''
-        return self.DESCR[self.__code] + ( ': '+self.__message if self.__message!=None else '') \
-            + ( "\n"+self.__detail if self.__detail is not None else '')
+        return self.DESCR[self.__code] + ( ': '+'; '.join(self.__message) if self.__message else '') \
+            + ( "\n"+"\n----------\n".join(self.__detail) if self.__detail else '')
     
     def change(self, code, message=None, detail=None):
         '''
@@ -73,34 +75,106 @@ class Ret(object):
             previous, then old condition is kept. Is condition is the same, then
             message is concatenated
         '''
-        if not code in self.CODES:
+        if code not in self._RANK:
             raise RuntimeError('Unvalid code: ' + str(code))
         if code == self.__code:
             if message != None:
-                if self.__message == None:
-                    self.__message = message
-                else:
-                    self.__message += '; ' + message
+                self.__message.append(message)
             if detail != None:
-                if self.__detail == None:
-                    self.__detail = detail
-                else:
-                    self.__detail += "\n----------\n" + detail
-        elif self.CODES.index(code) > self.CODES.index(self.__code):
+                self.__detail.append(detail)
+        elif self._RANK[code] > self._RANK[self.__code]:
             self.__code = code
-            self.__message = str(message)
-            self.__detail = str(detail)
+            self.__message = [str(message)]
+            self.__detail = [str(detail)]
         else:
             pass
 
 
-class MyTelnet(telnetlib.Telnet):
+class MyTelnet(object):
+    ''' Minimal telnet client, refuses every option negotiation '''
     
     PORT = 23
     TIMEOUT = 30
     
+    # Telnet protocol bytes
+    IAC = 255
+    DONT = 254
+    DO = 253
+    WONT = 252
+    WILL = 251
+    SB = 250
+    SE = 240
+    
     def __init__(self, host):
-        return telnetlib.Telnet.__init__(self, host, self.PORT, self.TIMEOUT)
+        self.sock = socket.create_connection((host, self.PORT), self.TIMEOUT)
+        self.raw = b''
+        self.buf = b''
+    
+    def __process(self):
+        """ Moves received data from raw to buf, handling telnet commands """
+        raw = self.raw
+        out = bytearray()
+        i = 0
+        while i < len(raw):
+            j = raw.find(self.IAC, i)
+            if j < 0:
+                out += raw[i:]
+                i = len(raw)
+                break
+            out += raw[i:j]
+            i = j
+            if j + 1 >= len(raw):
+                break
+            cmd = raw[j+1]
+            if cmd == self.IAC:
+                out.append(self.IAC)
+                i = j + 2
+            elif cmd in (self.DO, self.DONT, self.WILL, self.WONT):
+                if j + 2 >= len(raw):
+                    break
+                opt = raw[j+2]
+                if cmd == self.DO:
+                    self.sock.sendall(bytes((self.IAC, self.WONT, opt)))
+                elif cmd == self.WILL:
+                    self.sock.sendall(bytes((self.IAC, self.DONT, opt)))
+                i = j + 3
+            elif cmd == self.SB:
+                k = raw.find(bytes((self.IAC, self.SE)), j + 2)
+                if k < 0:
+                    break
+                i = k + 2
+            else:
+                i = j + 2
+        self.raw = raw[i:]
+        self.buf += out
+    
+    def read_until(self, expected, timeout=None):
+        """ Reads until expected is found or timeout expires, returns data read """
+        self.sock.settimeout(timeout if timeout is not None else self.TIMEOUT)
+        start = 0
+        while True:
+            pos = self.buf.find(expected, start)
+            if pos >= 0:
+                pos += len(expected)
+                res, self.buf = self.buf[:pos], self.buf[pos:]
+                return res
+            start = max(0, len(self.buf) - len(expected) + 1)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                chunk = b''
+            if not chunk:
+                res, self.buf = self.buf, b''
+                return res
+            self.raw += chunk
+            self.__process()
+    
+    def write(self, message):
+        """ Sends message, escaping IAC bytes """
+        self.sock.sendall(message.replace(bytes((self.IAC,)), bytes((self.IAC, self.IAC))))
+    
+    def close(self):
+        self.sock.close()
     
     def chat(self, expected, message):
         """ Send message to the telnet client after expected message has been received """
@@ -112,6 +186,9 @@ class MyTelnet(telnetlib.Telnet):
 
 class Main(object):
     
+    DOWN_RE = re.compile(rb'^near-end fast channel bit rate: ([0-9]+) kbps', re.M)
+    UP_RE = re.compile(rb'^far-end fast channel bit rate: ([0-9]+) kbps', re.M)
+    
     def __init__(self, host, pasw, warn=None, crit=None):
         self.ret = Ret()
         self.host = host
@@ -122,28 +199,27 @@ class Main(object):
     def __runCommand(self, cmd):
         conn = MyTelnet(self.host)
         
-        conn.chat('Password:', self.pasw + "\n")
-        conn.chat('tc>', cmd + "\n")
+        conn.chat(b'Password:', self.pasw.encode() + b"\n")
+        conn.chat(b'tc>', cmd.encode() + b"\n")
         
-        lines = conn.read_until('tc>').split("\n")
+        out = conn.read_until(b'tc>')
         
         conn.close()
         
-        return lines
+        return out
     
     def checkDataRate(self, type):
-        lines = self.__runCommand("wan adsl chandata")
+        out = self.__runCommand("wan adsl chandata")
         if type == 'down':
             end = 'near'
+            rateRe = self.DOWN_RE
         else:
             end = 'far'
-        for line in lines:
-            m = re.match(end+'-end fast channel bit rate: ([0-9]+) kbps', line)
-            if m:
-                rate = int(m.group(1))
-                break
-        else:
+            rateRe = self.UP_RE
+        m = rateRe.search(out)
+        if not m:
             raise RuntimeError(end + ' bit rate not found')
+        rate = int(m.group(1))
         
         if self.crit and rate < self.crit:
             self.ret.change(Ret.CRITICAL, "%iKbps" % rate)
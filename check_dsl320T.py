@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # kate: space-indent on; mixedindent off;
 
@@ -39,7 +39,7 @@ VERSION = '1.0'
 import argparse
 import os, sys
 import traceback
-import telnetlib
+import socket
 
 
 class Ret(object):
@@ -93,13 +93,91 @@ class Ret(object):
             pass
 
 
-class MyTelnet(telnetlib.Telnet):
+class MyTelnet(object):
+    ''' Minimal telnet client, refuses every option negotiation '''
     
     PORT = 23
     TIMEOUT = 30
     
+    # Telnet protocol bytes
+    IAC = 255
+    DONT = 254
+    DO = 253
+    WONT = 252
+    WILL = 251
+    SB = 250
+    SE = 240
+    
     def __init__(self, host):
-        return telnetlib.Telnet.__init__(self, host, self.PORT, self.TIMEOUT)
+        self.sock = socket.create_connection((host, self.PORT), self.TIMEOUT)
+        self.raw = b''
+        self.buf = b''
+    
+    def __process(self):
+        """ Moves received data from raw to buf, handling telnet commands """
+        raw = self.raw
+        out = bytearray()
+        i = 0
+        while i < len(raw):
+            j = raw.find(self.IAC, i)
+            if j < 0:
+                out += raw[i:]
+                i = len(raw)
+                break
+            out += raw[i:j]
+            i = j
+            if j + 1 >= len(raw):
+                break
+            cmd = raw[j+1]
+            if cmd == self.IAC:
+                out.append(self.IAC)
+                i = j + 2
+            elif cmd in (self.DO, self.DONT, self.WILL, self.WONT):
+                if j + 2 >= len(raw):
+                    break
+                opt = raw[j+2]
+                if cmd == self.DO:
+                    self.sock.sendall(bytes((self.IAC, self.WONT, opt)))
+                elif cmd == self.WILL:
+                    self.sock.sendall(bytes((self.IAC, self.DONT, opt)))
+                i = j + 3
+            elif cmd == self.SB:
+                k = raw.find(bytes((self.IAC, self.SE)), j + 2)
+                if k < 0:
+                    break
+                i = k + 2
+            else:
+                i = j + 2
+        self.raw = raw[i:]
+        self.buf += out
+    
+    def read_until(self, expected, timeout=None):
+        """ Reads until expected is found or timeout expires, returns data read """
+        self.sock.settimeout(timeout if timeout is not None else self.TIMEOUT)
+        start = 0
+        while True:
+            pos = self.buf.find(expected, start)
+            if pos >= 0:
+                pos += len(expected)
+                res, self.buf = self.buf[:pos], self.buf[pos:]
+                return res
+            start = max(0, len(self.buf) - len(expected) + 1)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                chunk = b''
+            if not chunk:
+                res, self.buf = self.buf, b''
+                return res
+            self.raw += chunk
+            self.__process()
+    
+    def write(self, message):
+        """ Sends message, escaping IAC bytes """
+        self.sock.sendall(message.replace(bytes((self.IAC,)), bytes((self.IAC, self.IAC))))
+    
+    def close(self):
+        self.sock.close()
     
     def chat(self, expected, message):
         """ Send message to the telnet client after expected message has been received """
@@ -122,11 +200,11 @@ class Main(object):
     def __runCommand(self, cmd):
         conn = MyTelnet(self.host)
         
-        conn.chat('login:', self.user + "\n")
-        conn.chat('Password:', self.pasw + "\n")
-        conn.chat('#', cmd + "\n")
+        conn.chat(b'login:', self.user.encode() + b"\n")
+        conn.chat(b'Password:', self.pasw.encode() + b"\n")
+        conn.chat(b'#', cmd.encode() + b"\n")
         
-        ans = int(conn.read_until('#').split("\n")[1])
+        ans = int(conn.read_until(b'#').split(b"\n")[1])
         
         conn.close()
         
@@ -36,12 +36,25 @@
 NAME = 'check_imap_email'
 VERSION = '0.2'
 
-import sys, traceback
+import os, sys, traceback
+import pickle
 import argparse
-from xml.etree import ElementTree
+from lxml import etree as ElementTree
 import re
 import imaplib
 
+# Compiled patterns, shared by all templates using the same expression
+_patterns = {}
+
+def compilePattern(pattern, flags=0):
+    ''' Like re.compile, but returns the same object for the same pattern '''
+    key = (pattern, flags)
+    try:
+        return _patterns[key]
+    except KeyError:
+        compiled = _patterns[key] = re.compile(pattern, flags)
+        return compiled
+
 class Ret:
     ''' Return code and text handler '''
     OK = 0
@@ -50,6 +63,8 @@ class Ret:
     UNKNOWN = 3
     
     CODES = (UNKNOWN, OK, WARNING, CRITICAL)
+    # Severity rank of every code, higher is worse
+    _RANK = {UNKNOWN: 0, OK: 1, WARNING: 2, CRITICAL: 3}
     DESCR = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
 
     def __init__(self):
@@ -72,7 +87,7 @@ class Ret:
             previous, then old condition is kept. Is condition is the same, then
             message is concatenated
         '''
-        if not code in self.CODES:
+        if code not in self._RANK:
             raise RuntimeError('Unvalid code: ' + str(code))
         if code == self.__code:
             if message != None:
@@ -85,7 +100,7 @@ class Ret:
                     self.__detail = detail
                 else:
                     self.__detail += "\n----------\n" + detail
-        elif CODES.index(code) > CODES.index(self.__code):
+        elif self._RANK[code] > self._RANK[self.__code]:
             self.__code = code
             self.__message = str(message)
             self.__detail = str(detail)
@@ -93,50 +108,124 @@ class Ret:
             pass
     
 class Config:
-    ''' Parsed representation of configuration '''
+    ''' Parsed representation of configuration. The data read from the
+        configuration is cached in a pickle file next to it, which is reused
+        until the configuration is modified '''
     
     def __init__(self, filename):
-        self.__xml = ElementTree.parse(filename)
+        self.__filename = filename
+        self.__cachefile = filename + '.cache'
+        self.__mtime = os.stat(filename).st_mtime
+        self.__data = {}
+        self.__items = {}
+        self.__complete = False
+        self.__loadCache()
+    
+    def __loadCache(self):
+        try:
+            with open(self.__cachefile, 'rb') as f:
+                cache = pickle.load(f)
+        except Exception:
+            return
+        if cache.get('mtime') == self.__mtime:
+            self.__data = cache['data']
+            self.__complete = True
+    
+    def __writeCache(self):
+        ''' Writes the cache, readable by the owner only since folders
+            contain passwords '''
+        tmpfile = self.__cachefile + '.' + str(os.getpid())
+        try:
+            fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'mtime': self.__mtime, 'data': self.__data}, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, self.__cachefile)
+        except (IOError, OSError):
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+    
+    def load(self, *wanted):
+        ''' Reads the given (type, id) elements. When the cache can be written
+            the whole file is parsed, otherwise parsing stops as soon as all
+            the wanted elements are found '''
+        if self.__complete:
+            return
+        missing = set(w for w in wanted if w not in self.__data)
+        if not missing:
+            return
+        cacheable = os.access(os.path.dirname(os.path.abspath(self.__cachefile)), os.W_OK)
+        for event, elem in ElementTree.iterparse(self.__filename, events=('end',), tag=('template', 'folder')):
+            key = (elem.tag, elem.get('id'))
+            # On duplicate ids the first definition wins
+            if key not in self.__data and (key in missing or cacheable):
+                if elem.tag == 'template':
+                    self.__data[key] = self.Template.read(elem)
+                else:
+                    self.__data[key] = self.Folder.read(elem)
+                missing.discard(key)
+                if not missing and not cacheable:
+                    break
+            elem.clear()
+        if cacheable:
+            self.__complete = True
+            self.__writeCache()
     
     def getTemplate(self, name):
         ''' Returns a template by ID '''
-        return self.Template(self.__findNodeOfTypeById('template',name))
+        return self.__getItemOfTypeById('template',name)
     
     def getFolder(self, name):
         ''' Returns a folder by ID '''
-        return self.Folder(self.__findNodeOfTypeById('folder',name))
+        return self.__getItemOfTypeById('folder',name)
     
-    def __findNodeOfTypeById(self, nType, nId):
-        node = None
-        for n in self.__xml.findall(nType):
-            if n.get('id') == nId:
-                node = n
-                break
-        if node == None:
-            raise self.ElementNotFoundError(str(nType).capitalize() + ' ' + str(nId) + ' not found!')
-        return node
+    def __getItemOfTypeById(self, nType, nId):
+        key = (nType, nId)
+        if key not in self.__items:
+            self.load(key)
+            try:
+                data = self.__data[key]
+            except KeyError:
+                raise self.ElementNotFoundError(str(nType).capitalize() + ' ' + str(nId) + ' not found!')
+            if nType == 'template':
+                self.__items[key] = self.Template(data)
+            else:
+                self.__items[key] = self.Folder(data)
+        return self.__items[key]
+    
+    # Items are built from plain data, so that it can be pickled
     
     class Folder:
-        def __init__(self, node):
-            self.server = node.get('server')
-            self.user = node.get('user')
-            self.pwd = node.get('pass')
-            self.folder = node.get('folder')
+        def __init__(self, data):
+            self.server = data.get('server')
+            self.user = data.get('user')
+            self.pwd = data.get('pass')
+            self.folder = data.get('folder')
+        
+        @staticmethod
+        def read(node):
+            return dict(node.attrib)
     
     class Template:
         
-        def __init__(self, node):
+        def __init__(self, data):
             self.subjects = []
             self.bodies = []
-            for s in node.findall('subject'):
-                self.subjects.append(self.Subject(s, '^Subject: ', r'\r?$'))
-            for s in node.findall('body'):
-                self.bodies.append(self.Body(s))
+            for text, status in data['subjects']:
+                self.subjects.append(self.Subject(text, status, '^Subject: ', r'\r?$'))
+            for text, status in data['bodies']:
+                self.bodies.append(self.Body(text, status))
+        
+        @staticmethod
+        def read(node):
+            return {
+                'subjects': [(s.text, s.get('status')) for s in node.findall('subject')],
+                'bodies': [(s.text, s.get('status')) for s in node.findall('body')],
+            }
         
         class MailPart:
-            def __init__(self, node, prepend='', append=''):
-                self.re = re.compile(prepend + node.text + append, re.M)
-                self.status = node.get('status')
+            def __init__(self, text, status, prepend='', append=''):
+                self.re = compilePattern(prepend + text + append, re.M)
+                self.status = status
         
         class Subject(MailPart):
             pass
@@ -165,6 +254,9 @@ class Main:
         ''' Run the checks '''
         retval = Ret()
         
+        # Read both the template and the folder in a single pass
+        self.__config.load(('template', self.__args.template), ('folder', self.__args.folder))
+        
         # Load the template
         template = self.__config.getTemplate(self.__args.template)
         
@@ -34,9 +34,14 @@
 
 import sys
 import ssl
+import gzip
+import time
 import logging
 import hashlib
 import datetime
+import functools
+import collections
+import concurrent.futures
 import traceback
 import lxml.etree
 import http.client
@@ -46,15 +51,44 @@ class HpeMsaCliApiError(Exception):
 	pass
 
 
+@functools.lru_cache(maxsize=None)
+def sslContext(verify):
+	''' Returns the SSL context shared by all the connections '''
+	if verify:
+		return ssl.create_default_context()
+	return ssl._create_unverified_context()
+
+
+class HpeMsaHTTPSConnection(http.client.HTTPSConnection):
+	''' HTTPS connection resuming the previous TLS session when reconnecting '''
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.session = None
+
+	def connect(self):
+		http.client.HTTPConnection.connect(self)
+		server_hostname = self._tunnel_host if self._tunnel_host else self.host
+		self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.session)
+
+	def close(self):
+		# With TLS 1.3 the session ticket is only known after some traffic.
+		# Socket is still a plain one when the handshake failed
+		session = getattr(self.sock, 'session', None)
+		if session is not None:
+			self.session = session
+		super().close()
+
+
 class HpeMsaCliElem:
 	''' Base class for property and objects '''
 
-	def __init__(self, xml):
-		self.log = logging.getLogger('msaelem')
-		self.xml = xml
-		self.attrs = {}
-		for key in self.xml.keys():
-			self.attrs[key] = self.xml.get(key)
+	__slots__ = ('attrs',)
+
+	log = logging.getLogger('msaelem')
+
+	def __init__(self, attrs):
+		self.attrs = attrs
 
 	def __getitem__(self, key):
 		return self.attrs[key]
@@ -69,15 +103,15 @@ class HpeMsaCliElem:
 class HpeMsaCliProperty(HpeMsaCliElem):
 	''' Represents a property as returned by the API. '''
 
-	def __init__(self, xml):
-		super().__init__(xml)
-		if self.xml.tag != 'PROPERTY':
-			raise ValueError('XML root must be a property')
+	__slots__ = ('value',)
+
+	def __init__(self, attrs, text):
+		super().__init__(attrs)
 
 		if self['type'] == 'string':
-			self.value = self.xml.text
+			self.value = text
 		elif self['type'].startswith('uint') or self['type'].startswith('sint'):
-			self.value = int(self.xml.text)
+			self.value = int(text)
 		else:
 			raise NotImplementedError('Property type {} not implemented'.format(self['type']))
 
@@ -91,32 +125,49 @@ class HpeMsaCliProperty(HpeMsaCliElem):
 class HpeMsaCliObject(HpeMsaCliElem):
 	''' Represents an object as returned by the API. Objects contains properties and objects '''
 
+	__slots__ = ('props', 'children')
+
 	def __init__(self, xml):
-		super().__init__(xml)
-		if self.xml.tag != 'OBJECT':
+		if xml.tag != 'OBJECT':
 			raise ValueError('XML root must be an object')
+		super().__init__(dict(xml.attrib))
+		# Properties are converted lazily, on first access. Only their plain
+		# attributes and text are kept, so that no XML node stays alive
 		self.props = {}
-		for child in self.xml:
+		self.children = {}
+		for child in xml:
 			if child.tag != 'PROPERTY':
 				#TODO: Support nested objects
 				self.log.info('Skipping nested object "%s"', child.tag)
 				continue
-			prop = HpeMsaCliProperty(child)
-			self.props[prop['name']] = prop
+			self.children[child.get('name')] = (dict(child.attrib), child.text)
+
+	def __parseAll(self):
+		for key in list(self.children):
+			self[key]
 
 	def __getitem__(self, key):
-		return self.props[key]
+		try:
+			return self.props[key]
+		except KeyError:
+			prop = self.props[key] = HpeMsaCliProperty(*self.children.pop(key))
+			return prop
 
 	def __iter__(self):
+		self.__parseAll()
 		return iter(self.props.values())
 
 	def __str__(self):
+		self.__parseAll()
 		return 'O<{}> {}'.format(self.attrs, self.props)
 
 
 class HpeMsaCliApi:
 	''' Connects to the MSA2050 Storage via the web API '''
 
+	# Seconds a command response is reused for
+	CACHE_TTL = 10
+
 	def __init__(self, host, user='monitor', pwd='', ssl=False, timeout=30, verifycrt=False):
 		self.log = logging.getLogger('2050cli')
 		self.host = host
@@ -126,8 +177,12 @@ class HpeMsaCliApi:
 		self.timeout = 30
 		self.verifycrt = verifycrt
 
+		# Login digest never changes for a given user and password
+		self.digest = hashlib.sha256('{}_{}'.format(self.user, self.pwd).encode()).hexdigest()
+
 		self.conn = None
 		self.token = None
+		self.cache = {}
 
 	def connect(self):
 		if self.ssl:
@@ -135,8 +190,7 @@ class HpeMsaCliApi:
 				self.log.debug('Initing HTTPS verified connection')
 			else:
 				self.log.debug('Initing HTTPS unverified connection')
-				unsafectx = ssl._create_unverified_context()
-			self.conn = http.client.HTTPSConnection(self.host, timeout=self.timeout, context=unsafectx)
+			self.conn = HpeMsaHTTPSConnection(self.host, timeout=self.timeout, context=sslContext(self.verifycrt))
 		else:
 			self.log.debug('Initing HTTP connection')
 			self.conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
@@ -151,6 +205,8 @@ class HpeMsaCliApi:
 
 		headers = {
 			'User-Agent': 'check_msa2050.py',
+			'Connection': 'keep-alive',
+			'Accept-Encoding': 'gzip',
 			'dataType': 'ipa',
 		}
 		if self.token:
@@ -160,58 +216,101 @@ class HpeMsaCliApi:
 		self.log.debug('Requesting %s, h:%s', path, headers)
 		self.conn.request('GET', path, headers=headers)
 		res = self.conn.getresponse()
-		data = res.read()
 		if res.status != 200:
+			data = res.read()
 			self.log.error('%s status received', res.status)
 			self.log.error(data)
 			raise HpeMsaCliApiError('{} status received'.format(res.status))
 
+		# XML is very verbose and compresses well
+		source = res
+		if res.getheader('Content-Encoding') == 'gzip':
+			source = gzip.GzipFile(fileobj=res)
+
+		# Build objects while the response streams in, releasing parsed nodes
+		objs = []
+		context = lxml.etree.iterparse(source, events=('end',), tag='OBJECT')
 		try:
-			root = lxml.etree.fromstring(data)
-		except:
-			self.log.error('Error parsing XML object')
-			self.log.error(data)
+			for event, elem in context:
+				parent = elem.getparent()
+				if parent is None or parent.getparent() is not None:
+					# Nested object, handled by its parent
+					continue
+				if self.log.isEnabledFor(logging.DEBUG):
+					self.log.debug(lxml.etree.tostring(elem, encoding='unicode', pretty_print=True))
+				objs.append(HpeMsaCliObject(elem))
+				elem.clear()
+				while elem.getprevious() is not None:
+					del parent[0]
+		except lxml.etree.XMLSyntaxError as e:
+			self.log.error('Error parsing XML object: %s', e)
 			raise HpeMsaCliApiError('Error parsing XML object')
 
-		self.log.debug(lxml.etree.tostring(root, encoding='unicode', pretty_print=True))
-		if root.tag != 'RESPONSE':
+		if context.root is None or context.root.tag != 'RESPONSE':
 			self.log.error('Response node is not root')
 			raise HpeMsaCliApiError('Response node is not root')
 
-		res = []
-		for child in root:
-			obj = HpeMsaCliObject(child)
-			res.append(obj)
-
-		self.log.debug(res)
-		return res
+		self.log.debug(objs)
+		return objs
 
 	def login(self):
 		''' Does initial login '''
 		self.log.debug('Logging in')
-		hash = hashlib.sha256()
-		hash.update(self.user.encode())
-		hash.update(b'_')
-		hash.update(self.pwd.encode())
-
-		path = 'login/' + hash.hexdigest()
+		path = 'login/' + self.digest
 		res = self.request(path)
 		if res[0]['response-type-numeric'].value != 0:
 			raise HpeMsaCliApiError('Authentication unsuccesful')
 
 		self.token = res[0]['response'].value
-		self.log.debug('Logged in with token {}'.format(self.token))
+		self.log.debug('Logged in with token %s', self.token)
 
 	def cmd(self, cmd):
-		''' Executes a command, connect and login automatically when needed
+		''' Executes a command, connect and login automatically when needed.
+		Responses are reused for CACHE_TTL seconds
 		@param cmd iterable: The command (es. ['show', 'disk'])
 		'''
 		if not self.token:
 			self.login()
 
-		self.log.debug('Executing command "{}"'.format(' '.join(cmd)))
 		path = '/'.join(cmd)
-		return self.request(path)
+		cached = self.cache.get(path)
+		if cached and time.monotonic() - cached[0] < self.CACHE_TTL:
+			self.log.debug('Using cached response for command "%s"', path)
+			return cached[1]
+
+		self.log.debug('Executing command "%s"', path)
+		res = self.request(path)
+		self.cache[path] = (time.monotonic(), res)
+		return res
+
+	def prefetch(self, cmds):
+		''' Executes the given commands in parallel, each one on its own
+		connection, and caches their responses for the following cmd() calls
+		@param cmds list: The commands, as accepted by cmd()
+		'''
+		if not self.token:
+			self.login()
+		session = None
+		if self.ssl and self.conn:
+			# Live socket session, or the one saved when it was closed
+			session = getattr(self.conn.sock, 'session', None) or self.conn.session
+
+		def fetch(cmd):
+			worker = HpeMsaCliApi(self.host, self.user, self.pwd, self.ssl, self.timeout, self.verifycrt)
+			worker.token = self.token
+			if session is not None:
+				# Resume the login TLS session instead of a full handshake
+				worker.connect()
+				worker.conn.session = session
+			try:
+				return worker.request('/'.join(cmd))
+			finally:
+				if worker.conn:
+					worker.conn.close()
+
+		with concurrent.futures.ThreadPoolExecutor(len(cmds)) as pool:
+			for cmd, res in zip(cmds, pool.map(fetch, cmds)):
+				self.cache['/'.join(cmd)] = (time.monotonic(), res)
 
 
 class Main:
@@ -226,6 +325,11 @@ class Main:
 	SPACE_WARN_PCT = 85
 	SPACE_CRIT_PCT = 95
 
+	# Checks run by the "all" check
+	CHECKS = ('disks', 'diskstemp', 'volumes', 'system', 'events')
+	# Commands used by CHECKS, fetched in parallel by the "all" check
+	COMMANDS = (('show', 'disks'), ('show', 'volumes'), ('show', 'system'), ('show', 'events', 'error'))
+
 	def __init__(self, host, user='monitor', pwd='', ssl=False):
 		self.log = logging.getLogger('main')
 		self.host = host
@@ -233,6 +337,8 @@ class Main:
 		self.pwd = pwd
 		self.ssl = ssl
 		self.cli = HpeMsaCliApi(self.host, self.user, self.pwd, self.ssl)
+		# When not None, check results are collected here instead of printed
+		self.collected = None
 
 	def run(self, check):
 		if not check.isalpha():
@@ -245,20 +351,22 @@ class Main:
 
 		return method()
 
-	def _printStatus(self, status, summary=None):
+	def _statusText(self, status, summary=None):
 		if status == self.OK:
-			print('OK', end='')
+			text = 'OK'
 		elif status == self.WARNING:
-			print('WARNING', end='')
+			text = 'WARNING'
 		elif status == self.CRITICAL:
-			print('CRITICAL', end='')
+			text = 'CRITICAL'
 		else:
-			print('UNKNOWN', end='')
+			text = 'UNKNOWN'
 
 		if summary:
-			print(': ', end='')
-			print(summary, end='')
-		print()
+			text += ': ' + summary
+		return text
+
+	def _printStatus(self, status, summary=None):
+		print(self._statusText(status, summary))
 
 	def _check(self, cmd):
 		''' Base check function '''
@@ -276,6 +384,10 @@ class Main:
 
 	def _ret(self, status, message=None, summary=None):
 		''' Base return function '''
+		if self.collected is not None:
+			self.collected.append((status, summary, message))
+			return status
+
 		self._printStatus(status, summary)
 		if message:
 			print(', '.join(message))
@@ -372,19 +484,13 @@ class Main:
 	def events(self):
 		res, status, message = self._check(('show', 'events', 'error'))
 
-		severities = {}
-		for obj in res:
-			if obj.attrs['basetype'] == 'events':
-				count += 1
-				severity = obj['severity'].value
-				if severity not in severities:
-					severities[severity] = 0
-				severities[severity] += 1
+		severities = collections.Counter(obj['severity'].value for obj in res
+			if obj.attrs['basetype'] == 'events')
 
-				if severity in ('CRITICAL', 'ERROR'):
-					status = self.CRITICAL
-				elif severity == 'WARNING':
-					status = max(status, self.WARNING)
+		if severities.keys() & {'CRITICAL', 'ERROR'}:
+			status = self.CRITICAL
+		elif 'WARNING' in severities:
+			status = max(status, self.WARNING)
 
 		if not severities:
 			message.append('no events')
@@ -393,11 +499,32 @@ class Main:
 
 		return self._ret(status, None, ', '.join(message))
 
+	def all(self):
+		''' Runs all the checks, fetching their data in parallel with a single login '''
+		self.cli.prefetch(self.COMMANDS)
+
+		self.collected = []
+		try:
+			for check in self.CHECKS:
+				getattr(self, check)()
+			collected = self.collected
+		finally:
+			self.collected = None
+
+		status = max(res[0] for res in collected)
+		self._printStatus(status, ', '.join('{} {}'.format(check, self._statusText(res[0]))
+			for check, res in zip(self.CHECKS, collected)))
+		for check, (substatus, summary, message) in zip(self.CHECKS, collected):
+			print('{}: {}'.format(check, self._statusText(substatus, summary)))
+			if message:
+				print(', '.join(message))
+		return status
+
 
 if __name__ == '__main__':
 	try:
 		import argparse
-		cmds = ('disks', 'diskstemp', 'volumes', 'system', 'events')
+		cmds = Main.CHECKS + ('all',)
 		parser = argparse.ArgumentParser(description='MSA2050 nagios plugin')
 		parser.add_argument('host', help='The hostname or IP address')
 		parser.add_argument('check', choices=cmds, help='What to check')
@@ -7,9 +7,12 @@ Checks temperature from USB dongle
 @author Gabriele Tozzi <gabriele@tozzi.eu>
 '''
 
+import os
 import sys
+import glob
 import time
-import temperusb
+import select
+import struct
 import argparse
 
 OK = 0
@@ -17,22 +20,80 @@ WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+# USB id of the TEMPer sensors supported by the raw reader
+HID_ID = 'HID_ID=0003:00000C45:00007401'
+READ_CMD = b'\x01\x80\x33\x01\x00\x00\x00\x00'
+TIMEOUT = 5
+
+
+def isSensor(path):
+    ''' Tells whether the given hidraw node is the temperature interface of a TEMPer '''
+    devdir = os.path.join('/sys/class/hidraw', os.path.basename(path), 'device')
+    try:
+        with open(os.path.join(devdir, 'uevent')) as f:
+            if HID_ID not in f.read().split():
+                return False
+    except OSError:
+        return False
+    # The sensor is on the second USB interface, the first one is a keyboard
+    return os.path.basename(os.path.dirname(os.path.realpath(devdir))).endswith('.1')
+
+
+def findSensor():
+    ''' Returns the hidraw node of the sensor, None if not found '''
+    for node in sorted(glob.glob('/sys/class/hidraw/hidraw*')):
+        path = os.path.join('/dev', os.path.basename(node))
+        if isSensor(path):
+            return path
+    return None
+
+
+def readSensor(path):
+    ''' Reads the temperature straight from the hidraw node '''
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.write(fd, READ_CMD)
+        if not select.select([fd], [], [], TIMEOUT)[0]:
+            raise TimeoutError('Timeout reading from {}'.format(path))
+        data = os.read(fd, 8)
+    finally:
+        os.close(fd)
+    return struct.unpack('>h', data[2:4])[0] / 256.0
+
+
+def readTemperusb():
+    ''' Reads the temperature using the temperusb library, slower '''
+    import temperusb
+
+    th = temperusb.TemperHandler()
+    devs = th.get_devices()
+    if not len(devs):
+        return None
+
+    dev = devs[0]
+    return dev.get_temperatures()[0]['temperature_c']
+
 try:
     parser = argparse.ArgumentParser(description='Check temperature sensor')
     parser.add_argument('-w', dest='warn', type=int, default=25)
     parser.add_argument('-c', dest='crit', type=int, default=35)
     args = parser.parse_args()
 
-    th = temperusb.TemperHandler()
-    devs = th.get_devices()
-    if not len(devs):
+    t = None
+    path = findSensor()
+    if path:
+        try:
+            t = readSensor(path)
+        except OSError:
+            # Not readable by this user or detached by temperusb
+            pass
+    if t is None:
+        t = readTemperusb()
+    if t is None:
         print('UNKNOWN')
         print('Error: device not found')
         sys.exit(UNKNOWN)
 
-    dev = devs[0]
-    t = dev.get_temperatures()[0]['temperature_c']
-
     if t >= args.crit:
         status = 'CRITICAL'
         code = CRITICAL
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # kate: space-indent on; mixedindent off;
 
@@ -40,7 +40,11 @@ import re
 import argparse
 import os, sys
 import traceback
-import telnetlib
+import socket
+
+
+# Ping summary line, as printed by the intermediate host
+PING_RE = re.compile(rb'^\s*([0-9]+) packets transmitted, ([0-9]+) packets received, ([0-9]+)% packet loss\s*$', re.M)
 
 
 class Ret(object):
@@ -51,6 +55,8 @@ class Ret(object):
     UNKNOWN = 3
     
     CODES = (UNKNOWN, OK, WARNING, CRITICAL)
+    # Severity rank of every code, higher is worse
+    _RANK = {UNKNOWN: 0, OK: 1, WARNING: 2, CRITICAL: 3}
     DESCR = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
 
     def __init__(self):
@@ -73,7 +79,7 @@ class Ret(object):
             previous, then old condition is kept. Is condition is the same, then
             message is concatenated
         '''
-        if not code in self.CODES:
+        if code not in self._RANK:
             raise RuntimeError('Unvalid code: ' + str(code))
         if code == self.__code:
             if message != None:
@@ -86,7 +92,7 @@ class Ret(object):
                     self.__detail = detail
                 else:
                     self.__detail += "\n----------\n" + detail
-        elif self.CODES.index(code) > self.CODES.index(self.__code):
+        elif self._RANK[code] > self._RANK[self.__code]:
             self.__code = code
             self.__message = str(message)
             self.__detail = str(detail)
@@ -94,13 +100,98 @@ class Ret(object):
             pass
 
 
-class MyTelnet(telnetlib.Telnet):
+# Status and message for every packet loss percentage
+LOSS_STATUS = tuple(
+    (Ret.OK if loss == 0 else Ret.CRITICAL if loss == 100 else Ret.WARNING, "%d%% packet loss" % loss)
+    for loss in range(101)
+)
+
+
+class MyTelnet(object):
+    ''' Minimal telnet client, refuses every option negotiation '''
     
     PORT = 23
     TIMEOUT = 30
     
+    # Telnet protocol bytes
+    IAC = 255
+    DONT = 254
+    DO = 253
+    WONT = 252
+    WILL = 251
+    SB = 250
+    SE = 240
+    
     def __init__(self, host):
-        return telnetlib.Telnet.__init__(self, host, self.PORT, self.TIMEOUT)
+        self.sock = socket.create_connection((host, self.PORT), self.TIMEOUT)
+        self.raw = b''
+        self.buf = b''
+    
+    def __process(self):
+        """ Moves received data from raw to buf, handling telnet commands """
+        raw = self.raw
+        out = bytearray()
+        i = 0
+        while i < len(raw):
+            j = raw.find(self.IAC, i)
+            if j < 0:
+                out += raw[i:]
+                i = len(raw)
+                break
+            out += raw[i:j]
+            i = j
+            if j + 1 >= len(raw):
+                break
+            cmd = raw[j+1]
+            if cmd == self.IAC:
+                out.append(self.IAC)
+                i = j + 2
+            elif cmd in (self.DO, self.DONT, self.WILL, self.WONT):
+                if j + 2 >= len(raw):
+                    break
+                opt = raw[j+2]
+                if cmd == self.DO:
+                    self.sock.sendall(bytes((self.IAC, self.WONT, opt)))
+                elif cmd == self.WILL:
+                    self.sock.sendall(bytes((self.IAC, self.DONT, opt)))
+                i = j + 3
+            elif cmd == self.SB:
+                k = raw.find(bytes((self.IAC, self.SE)), j + 2)
+                if k < 0:
+                    break
+                i = k + 2
+            else:
+                i = j + 2
+        self.raw = raw[i:]
+        self.buf += out
+    
+    def read_until(self, expected, timeout=None):
+        """ Reads until expected is found or timeout expires, returns data read """
+        self.sock.settimeout(timeout if timeout is not None else self.TIMEOUT)
+        start = 0
+        while True:
+            pos = self.buf.find(expected, start)
+            if pos >= 0:
+                pos += len(expected)
+                res, self.buf = self.buf[:pos], self.buf[pos:]
+                return res
+            start = max(0, len(self.buf) - len(expected) + 1)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                chunk = b''
+            if not chunk:
+                res, self.buf = self.buf, b''
+                return res
+            self.raw += chunk
+            self.__process()
+    
+    def write(self, message):
+        """ Sends message, escaping IAC bytes """
+        self.sock.sendall(message.replace(bytes((self.IAC,)), bytes((self.IAC, self.IAC))))
+    
+    def close(self):
+        self.sock.close()
     
     def chat(self, expected, message):
         """ Send message to the telnet client after expected message has been received """
@@ -122,28 +213,28 @@ class Main(object):
     def runCheck(self):
         conn = MyTelnet(self.inter)
         
-        conn.chat('login: ', self.user + "\n")
-        conn.chat('Password: ', self.pasw + "\n")
-        conn.chat('# ', 'ping -c 4 -q ' + self.host + "\n")
-        
-        lines = conn.read_until('# ')
-        
+        conn.chat(b'login: ', self.user.encode() + b"\n")
+        # Send the ping command right after the password, without waiting for
+        # the shell prompt: the tty buffers it until the shell reads it
+        conn.chat(b'Password: ', self.pasw.encode() + b"\n"
+            + b'ping -c 4 -q ' + self.host.encode() + b"\n")
+
+        # First prompt is the one printed after login, ping output comes
+        # after it and ends with the next one
+        res = conn.read_until(b'# ')
+        if not res.endswith(b'# '):
+            conn.close()
+            raise RuntimeError('Unexpected answer: %s' % res)
+        out = conn.read_until(b'# ')
+
         conn.close()
         
-        resre = re.compile(r'^([0-9]+) packets transmitted, ([0-9]+) packets received, ([0-9]+)% packet loss$')
-        for l in lines.split("\n"):
-            m = resre.match(l.strip())
-            if m:
-                loss = int(m.group(3))
-                if loss == 100:
-                    self.ret.change(Ret.CRITICAL, "%d%% packet loss" % loss)
-                elif loss > 0:
-                    self.ret.change(Ret.WARNING, "%d%% packet loss" % loss)
-                else:
-                    self.ret.change(Ret.OK, "%d%% packet loss" % loss)
-                break
+        m = PING_RE.search(out)
+        if m:
+            code, message = LOSS_STATUS[min(int(m.group(3)), 100)]
+            self.ret.change(code, message)
         else:
-            self.ret.change(Ret.UNKNOWN, "PING answer not found" % loss, lines)
+            self.ret.change(Ret.UNKNOWN, "PING answer not found", out.decode(errors='replace'))
         
         return self.ret
 